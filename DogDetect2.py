@@ -84,21 +84,36 @@ import datetime
 import socket
 import time
 import json
-import mimetypes
+import shutil
+import queue
+import collections
+import struct
 import imutils
-from picamera.array import PiRGBArray
+import traceback
 from picamera import PiCamera
-from threading import Thread
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 from email.message import EmailMessage
 from email.utils import make_msgid
 from mscoco_label_map import category_map, category_index
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    Interpreter = None  # TFLite runtime is optional, the OpenCV DNN backend is used without it
+try:
+    from openvino.inference_engine import IECore
+except ImportError:
+    IECore = None       # OpenVINO is optional, required only to offload inference to an NCS2
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None  # ONNX Runtime is optional, required only for the quantized ONNX model
 '''
 Imports from private are constants that need to be created for a specific userID.  You may also wish
 to change the constant name GORDONS_EMAIL (unless your name is Gordon ;).  For obvious reasons private.py
 is not included in the repo.
 '''
-from private import SUDO_PASSWORD as SUDO_PASSWORD  # Sudo password needed to pet the watchdog
 from private import SENDER_EMAIL as SENDER_EMAIL    # E-mail account to use for sending e-mail notifications
 from private import PASSWORD as PASSWORD            # Password for email acount to send notificaitons
 from private import GORDONS_EMAIL as GORDONS_EMAIL  # Recipient email address
@@ -134,12 +149,60 @@ else:
 parser = argparse.ArgumentParser()
 parser.add_argument('--serviceMode', help='does not display images - use when running as a daemon service',
                     action='store_true')
+parser.add_argument('--dump-ring', dest='dumpRing', metavar='DIRECTORY',
+                    help='writes the images stored in the RAM disk ring buffer to DIRECTORY as JPEG files and exits')
 args = parser.parse_args()
 
+'''
+Detection images that are not sent as notifications are kept in a cyclical buffer on the RAM disk.  Rather than
+a file per image, a single preallocated file is memory mapped and divided into fixed size slots, so saving an
+image does not allocate inodes or update directory metadata on the tmpfs and the RAM disk usage is bounded.
+Each slot starts with a RING_HEADER of (JPEG length, capture time in seconds since the epoch, label), followed
+by the JPEG data.  A slot with a length of zero has not been written.  The images are extracted with --dump-ring.
+'''
+RING_FILE      = RAM_DISK + 'ring.bin'
+RING_SLOTS     = 100
+RING_SLOT_SIZE = 512 * 1024
+RING_HEADER    = struct.Struct('<Id16s')
+
+
+def dumpRing(directory):
+    '''
+    Writes each image stored in the ring buffer file to directory, as <capture time>_<label>.jpg.
+
+    Args:
+        directory (string): directory the JPEG files are written to, created if needed
+
+    Returns:
+        Nothing
+    '''
+    if not os.path.isfile(RING_FILE):
+        print(f"No ring buffer at {RING_FILE}")
+        return
+    os.makedirs(directory, exist_ok=True)
+    ring  = np.memmap(RING_FILE, dtype=np.uint8, mode='r')
+    count = 0
+    for offset in range(0, ring.size - RING_SLOT_SIZE + 1, RING_SLOT_SIZE):
+        length, captureTime, label = RING_HEADER.unpack_from(ring, offset)
+        if length == 0 or length > RING_SLOT_SIZE - RING_HEADER.size:
+            continue
+        label    = label.rstrip(b'\0').decode('ascii', errors='replace').replace(' ', '_')
+        fileName = f'{time.strftime("%Y%m%d_%H%M%S", time.localtime(captureTime))}_{label}.jpg'
+        start    = offset + RING_HEADER.size
+        with open(os.path.join(directory, fileName), 'wb') as imageFile:
+            imageFile.write(ring[start:start + length].tobytes())
+        count += 1
+    print(f"Wrote {count} images to {directory}")
+
+
+if args.dumpRing:
+    dumpRing(args.dumpRing)
+    raise SystemExit
+
 '''
 To ensure we can quickly turn off the watch dog mode should an issue be introduced, the 
 watchdog petting, which enables the watchdog the first time it is performed, must be 
-enabled by the presense of the ENABLE_WATCHDOG flag being set to 1.  Moving or deleting
+enabled by the presense of the ENABLE_WATCHDOG flag being set to 1 in the JSON config file.  Moving or deleting
 the config file will prevent the watdog from being run the next time the script is called.
 This is useful to be able to disable the watchdog and then take the execution out of 
 service mode.
@@ -147,22 +210,32 @@ service mode.
 WATCH_DOG_ENABLE       = False
 CONFIG_FILE            = "/home/pi/Software/Python/DogDetect2/sc_config.txt"
 if os.path.isfile(CONFIG_FILE):
-    workingConfigFile = open(RAM_DISK + 'working_config.txt', "w")
-    with open(CONFIG_FILE) as configFile:
-        for line in configFile:
-            workingConfigFile.write(line)
-            parameter = line.rstrip()
-            if parameter == "ENABLE_WATCHDOG=1":
-                WATCH_DOG_ENABLE = True
-    workingConfigFile.close()
+    shutil.copyfile(CONFIG_FILE, RAM_DISK + 'working_config.txt')
+    try:
+        with open(CONFIG_FILE) as configFile:
+            config = json.load(configFile)
+        if isinstance(config, dict):
+            WATCH_DOG_ENABLE = config.get("ENABLE_WATCHDOG", 0) == 1
+        else:
+            print("Config file is not a JSON object, running without the watchdog")
+    except ValueError as e:
+        print(f"Unable to parse config file, running without the watchdog: {e}")
 else:
     print("Running without a config file")
 
 WATCH_DOG_PET_INTERVAL = 5 # Watch Dog Petting interval (must be less than 15 seconds or system will reboot
+PET_TIME_FORMAT        = "%x %I:%M:%S %p" # Time format of the pet time written to last_pet_time.txt
 keepAlive              = 0
 
 SSL_PORT          = 465  # For SSL
 GMAIL_SMTP_SERVER = "smtp.gmail.com"
+SMTP_HEARTBEAT    = 240  # Seconds between NOOPs keeping the SMTP session alive
+SMTP_TIMEOUT      = 30   # Seconds before a blocked SMTP socket operation fails, so a half open session can not hang
+SSL_CONTEXT       = ssl.create_default_context()  # Created once, loading the CA bundle from the SD card is slow
+
+# A single logged in SMTP session is shared by all senders, avoiding a TCP + TLS handshake and login per message
+smtpLock   = Lock()
+smtpServer = None
 
 CYAN  = (255, 255, 0)
 RED   = (0,   0,   255)
@@ -172,7 +245,7 @@ WHITE = (255, 255, 255)
 # Times in seconds
 TIME_BETWEEN_MESSAGES  = 30
 ANIMAL_DETECT_DEBOUNCE = 10
-IMAGE_FILE             = RAM_DISK + 'Current.jpg'
+MOTION_HOLD_TIME       = 1   # Object detection continues this long after motion stops, to catch a stationary dog
 
 
 # Set up camera constants
@@ -183,14 +256,36 @@ IM_HEIGHT                 = 608
 scale_percent             = 25 * int(5000 / IM_WIDTH)  # percent of original size for displayed image
 FILTER_SCALE              = 4 # scaling applied on image prior to focus detection.
 FOCUS_SENSITIVITY         = 70 # Value on 100 point scale for degree of sensitivity, higher being more sensitive.
-FOCUS_THRESHOLD           = 40 # Threshold value from 0 to 255, determining the change of intensity to qualify as movement
+FOCUS_THRESHOLD           = 40 # Background subtractor variance threshold, determining the change of intensity to qualify as movement
+FOCUS_HISTORY             = 150 # Number of frames the background model is learned over
 PHASES                    = 3
 NIGHT_MODE_ON_THRESH      = 4
 NIGHT_MODE_OFF_THRESH     = 16
 NIGHT_MODE_FRAME_SLOWDOWN = 60
+BGR_WEIGHTS               = np.array([0.114, 0.587, 0.299], dtype=np.float32)  # BGR to gray coefficients for luma
+DARK_DETECT_STRIDE        = 32 # Pixel stride of the subsample the luma average is estimated from
+DARK_DETECT_SCALE         = 1 / (((IM_HEIGHT + DARK_DETECT_STRIDE - 1) // DARK_DETECT_STRIDE) *
+                                 ((IM_WIDTH + DARK_DETECT_STRIDE - 1) // DARK_DETECT_STRIDE))  # 1 / subsample pixels
 
 #### Initialize NN model ####
 
+'''
+Each phase runs its forward pass single threaded on its own core.  By default OpenCV starts a worker per CPU for
+every net, so PHASES nets on four cores oversubscribe the CPU and thrash the caches.  The last core is left for
+the capture loop and notifications: the main thread is pinned to it here, so every thread it starts afterwards
+(capture, notification, SMTP heartbeat, stats, watchdog) inherits that affinity, and the detection workers then
+pin themselves to the DETECTION_CORES.  With a single core everything shares it.
+'''
+cv2.setNumThreads(1)
+if hasattr(os, 'sched_getaffinity'):
+    AVAILABLE_CORES = sorted(os.sched_getaffinity(0))
+else:
+    AVAILABLE_CORES = list(range(os.cpu_count() or 1))
+DETECTION_CORES = AVAILABLE_CORES[:-1] or AVAILABLE_CORES
+CONTROL_CORES   = AVAILABLE_CORES[-1:]
+if hasattr(os, 'sched_setaffinity'):
+    os.sched_setaffinity(0, CONTROL_CORES)
+
 # Name of the directory containing the object detection module we're using
 PATH_TO_PROTO_BINARY = "/home/pi/Software/Python/DogDetect2/ssd_mobilenet_v2_frozen_inference_graph.pb"
 PATH_TO_PROTO_TEXT   = "/home/pi/Software/Python/DogDetect2/ssd_mobilenet_v2_coco_2018_03_29.pbtxt"
@@ -201,12 +296,257 @@ V3_BLOB_SIZE         = 320
 
 BLOB_SIZE = V2_BLOB_SIZE
 
+'''
+OpenVINO IR version of the same SSD Mobilenet V2 graph.  The plain OpenCV DNN backend does little layer fusion
+and is the single largest CPU cost in the system, the Inference Engine backend fuses Conv+BN+ReLU and uses NEON
+optimized kernels.  The IR is generated from the frozen graph with the model optimizer:
+
+mo --input_model ssd_mobilenet_v2_frozen_inference_graph.pb --input_shape [1,300,300,3]
+   --transformations_config ssd_v2_support.json --tensorflow_object_detection_api_pipeline_config pipeline.config
+
+When the OpenVINO python API is installed the IR is loaded directly through the Inference Engine, on an Intel
+NCS2 (MYRIAD VPU) when one is attached and on the CPU otherwise.  The VPU runs the network at ~30 fps, which
+frees the four ARM cores for motion detection and messaging and cuts the power drawn by inference to ~1W.
+A single network is loaded with one infer request per phase and is shared by all of the phases, rather than a
+copy of the weights per phase (~70MB each in FP32), which also leaves one copy of the weights competing for the
+Pi4's L2 cache and memory bandwidth.  On the CPU each request is limited to a single bound thread, so the
+phases do not oversubscribe the cores.  The IR is converted without --reverse_input_channels, so it takes the same RGB blob
+as the TensorFlow graph.
+
+Without the OpenVINO python API the IR is run on OpenCV's Inference Engine backend, and when the IR files are
+not present, or OpenCV was built without the Inference Engine, the TensorFlow graph is loaded on the default
+OpenCV backend.  Set DNN_TARGET to cv2.dnn.DNN_TARGET_MYRIAD when an NCS USB stick is attached.
+'''
+PATH_TO_IR_XML = "/home/pi/Software/Python/DogDetect2/ssd_mobilenet_v2_frozen_inference_graph.xml"
+PATH_TO_IR_BIN = "/home/pi/Software/Python/DogDetect2/ssd_mobilenet_v2_frozen_inference_graph.bin"
+DNN_TARGET     = cv2.dnn.DNN_TARGET_CPU
+
+'''
+INT8 post-training quantized version of the graph for the TFLite runtime.  The Pi4 NEON units deliver roughly
+twice the convolution throughput on int8 and the weights are a quarter of the FP32 size.  The model is produced
+off target from export_tflite_ssd_graph.py output with the TFLite converter, using captured yard images as the
+representative data set:
+
+converter.optimizations = [tf.lite.Optimize.DEFAULT]
+converter.representative_dataset = yardImages
+converter.inference_input_type = tf.uint8
+
+The quantized model takes a 300 x 300 RGB uint8 image directly, so no float blob is created.  It is used in
+preference to the OpenCV backends whenever the file and tflite_runtime are both present.
+'''
+PATH_TO_TFLITE = "/home/pi/Software/Python/DogDetect2/ssd_mobilenet_v2_int8.tflite"
+
+'''
+INT8 quantized ONNX version of the graph for ONNX Runtime.  The frozen graph is converted with tf2onnx and
+statically quantized (QDQ) off target with the same representative yard images as the TFLite model:
+
+python -m tf2onnx.convert --graphdef ssd_mobilenet_v2_frozen_inference_graph.pb --output ssd_mobilenet_v2.onnx
+    --inputs image_tensor:0 --outputs detection_boxes:0,detection_classes:0,detection_scores:0,num_detections:0
+quantize_static('ssd_mobilenet_v2.onnx', 'ssd_mobilenet_v2_int8.onnx', yardImageReader)
+
+Like the TFLite model it takes a 300 x 300 RGB uint8 image.  Each phase has its own single threaded session with
+its input and outputs bound once, the input being the phase's rgbBuf, so no input is copied per frame.
+'''
+PATH_TO_ONNX = "/home/pi/Software/Python/DogDetect2/ssd_mobilenet_v2_int8.onnx"
+ONNX_OUTPUTS = ('detection_boxes:0', 'detection_classes:0', 'detection_scores:0', 'num_detections:0')
+
+irFilesPresent = os.path.isfile(PATH_TO_IR_XML) and os.path.isfile(PATH_TO_IR_BIN)
+if IECore is not None and irFilesPresent:
+    INFERENCE_BACKEND = 'openvino'
+elif onnxruntime is not None and os.path.isfile(PATH_TO_ONNX):
+    INFERENCE_BACKEND = 'onnx'
+elif Interpreter is not None and os.path.isfile(PATH_TO_TFLITE):
+    INFERENCE_BACKEND = 'tflite'
+else:
+    INFERENCE_BACKEND = 'opencv'
+
+if INFERENCE_BACKEND == 'openvino':
+    ie           = IECore()
+    irNet        = ie.read_network(model=PATH_TO_IR_XML, weights=PATH_TO_IR_BIN)
+    irInputName  = next(iter(irNet.input_info))
+    irOutputName = next(iter(irNet.outputs))
+    irDevice     = 'MYRIAD' if any(device.startswith('MYRIAD') for device in ie.available_devices) else 'CPU'
+    irConfig     = {'CPU_THREADS_NUM': '1', 'CPU_BIND_THREAD': 'YES'} if irDevice == 'CPU' else {}
+    execNet      = ie.load_network(network=irNet, device_name=irDevice, config=irConfig, num_requests=PHASES)
+    print(f"OpenVINO inference running on {irDevice}")
+
+    # Infer requests not currently owned by a phase.  A request is held until its output has been copied, so
+    # another phase can not restart it in between wait() returning and the output being read.
+    irIdleRequests = queue.Queue()
+    for requestId in range(PHASES):
+        irIdleRequests.put(requestId)
+
+
+def loadNet():
+    '''
+    Loads the object detection network for a phase.  The quantized ONNX or TFLite model is used when available,
+    otherwise the OpenVINO IR on OpenCV's Inference Engine backend, falling back to the TensorFlow graph on
+    the default OpenCV backend.  Not used for the OpenVINO backend, which shares execNet across phases.
+
+    Returns:
+        cv2 NN, ONNX Runtime session or TFLite Interpreter: object detection neural network
+    '''
+    if INFERENCE_BACKEND == 'onnx':
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = 1
+        options.inter_op_num_threads = 1
+        return onnxruntime.InferenceSession(PATH_TO_ONNX, sess_options=options, providers=['CPUExecutionProvider'])
+    if INFERENCE_BACKEND == 'tflite':
+        interpreter = Interpreter(model_path=PATH_TO_TFLITE, num_threads=1)
+        interpreter.allocate_tensors()
+        return interpreter
+    if irFilesPresent:
+        try:
+            net = cv2.dnn.readNet(PATH_TO_IR_XML, PATH_TO_IR_BIN)
+            net.setPreferableBackend(cv2.dnn.DNN_BACKEND_INFERENCE_ENGINE)
+            net.setPreferableTarget(DNN_TARGET)
+            return net
+        except cv2.error as e:
+            print(f"Unable to load OpenVINO IR, using OpenCV backend: {e}")
+    return cv2.dnn.readNetFromTensorflow(PATH_TO_PROTO_BINARY, PATH_TO_PROTO_TEXT)
+
 # Create an NN instance for each phase
-cvNet = [cv2.dnn.readNetFromTensorflow(PATH_TO_PROTO_BINARY, PATH_TO_PROTO_TEXT) for _ in range(PHASES)]
+if INFERENCE_BACKEND != 'openvino':
+    cvNet = [loadNet() for _ in range(PHASES)]
+
+# Preprocessing buffers for each phase, allocated once so no image sized allocations are made per frame
+resizeBuf = [np.empty((BLOB_SIZE, BLOB_SIZE, 3), dtype=np.uint8) for _ in range(PHASES)]
+rgbBuf    = [np.empty((1, BLOB_SIZE, BLOB_SIZE, 3), dtype=np.uint8) for _ in range(PHASES)]  # TFLite / ONNX input
+blobBuf   = [np.empty((1, 3, BLOB_SIZE, BLOB_SIZE), dtype=np.float32) for _ in range(PHASES)]
+
+# Bind each ONNX session's input to its phase's rgbBuf and its outputs once
+if INFERENCE_BACKEND == 'onnx':
+    onnxBinding = []
+    for i in range(PHASES):
+        binding = cvNet[i].io_binding()
+        binding.bind_cpu_input(cvNet[i].get_inputs()[0].name, rgbBuf[i])
+        for outputName in ONNX_OUTPUTS:
+            binding.bind_output(outputName)
+        onnxBinding.append(binding)
+
+
+def packDetections(boxes, classes, scores, count, classOffset):
+    '''
+    Repacks SSD post processing outputs (boxes, classes, scores, count) into the OpenCV DetectionOutput layout.
+
+    Args:
+        boxes (numpy array): (ymin, xmin, ymax, xmax) box per detection, as a fraction of the image dimensions
+        classes (numpy array): class id per detection
+        scores (numpy array): score per detection
+        count (int): number of valid detections
+        classOffset (int): added to the class ids to make them match category_index
+
+    Returns:
+        numpy array: one row per detection [image id, class id, score, left, top, right, bottom]
+    '''
+    detections = np.zeros((count, 7), dtype=np.float32)
+    detections[:, 1]   = classes[:count] + classOffset
+    detections[:, 2]   = scores[:count]
+    detections[:, 3:7] = boxes[:count][:, [1, 0, 3, 2]]  # (ymin, xmin, ymax, xmax) to (left, top, right, bottom)
+    return detections
+
+
+def runDetector(phase, processFrame):
+    '''
+    Runs a forward pass of the object detection network on processFrame.  The TFLite and ONNX SSD post
+    processing outputs (boxes, classes, scores, count) are repacked into the OpenCV DetectionOutput layout so the caller
+    does not need to know which backend is in use.
+
+    Args:
+        phase (int): phase the frame was captured in, selects the network instance and buffers
+        processFrame (frame): BGR image to run object detection on
+
+    Returns:
+        numpy array: one row per detection [image id, class id, score, left, top, right, bottom], with the box
+        coordinates as a fraction of the processFrame dimensions
+    '''
+    cv2.resize(processFrame, (BLOB_SIZE, BLOB_SIZE), dst=resizeBuf[phase])
+    if INFERENCE_BACKEND in ('tflite', 'onnx'):
+        cv2.cvtColor(resizeBuf[phase], cv2.COLOR_BGR2RGB, dst=rgbBuf[phase][0])
+    else:
+        # BGR to RGB, HWC to CHW and uint8 to float32 in a single pass over the resized pixels
+        np.copyto(blobBuf[phase][0], resizeBuf[phase].transpose(2, 0, 1)[::-1])
+
+    if INFERENCE_BACKEND == 'openvino':
+        requestId = irIdleRequests.get()
+        try:
+            execNet.start_async(request_id=requestId, inputs={irInputName: blobBuf[phase]})
+            execNet.requests[requestId].wait()
+            return execNet.requests[requestId].output_blobs[irOutputName].buffer[0, 0].copy()
+        finally:
+            irIdleRequests.put(requestId)
+
+    net = cvNet[phase]
+    if INFERENCE_BACKEND == 'onnx':
+        net.run_with_iobinding(onnxBinding[phase])
+        boxes, classes, scores, count = onnxBinding[phase].copy_outputs_to_cpu()
+        return packDetections(boxes[0], classes[0], scores[0], int(count[0]), 0)  # Class ids are one based
+
+    if INFERENCE_BACKEND == 'tflite':
+        inputDetails  = net.get_input_details()[0]
+        outputDetails = net.get_output_details()
+        net.set_tensor(inputDetails['index'], rgbBuf[phase])
+        net.invoke()
+        boxes   = net.get_tensor(outputDetails[0]['index'])[0]
+        classes = net.get_tensor(outputDetails[1]['index'])[0]
+        scores  = net.get_tensor(outputDetails[2]['index'])[0]
+        count   = int(net.get_tensor(outputDetails[3]['index'])[0])
+        return packDetections(boxes, classes, scores, count, 1)  # TFLite class ids are zero based
+
+    net.setInput(blobBuf[phase])
+    return net.forward()[0, 0]
 
 #Calculate the focus detection sensitivity converting from a 100 point scale to a fraction of the detection area:
 focusSensitivity = int(50 / (FOCUS_SENSITIVITY * FOCUS_SENSITIVITY) * (IM_HEIGHT * IM_WIDTH) / (FILTER_SCALE * FILTER_SCALE))
 
+# Create a background subtractor for each phase.  MOG2 learns a per pixel model of the background, replacing the
+# 41x41 blur + absdiff against a periodically refreshed reference frame with a single NEON optimized pass.
+bgSub = [cv2.createBackgroundSubtractorMOG2(history=FOCUS_HISTORY, varThreshold=FOCUS_THRESHOLD, detectShadows=False)
+         for _ in range(PHASES)]
+
+# Motion mask buffers for each phase, so the mask and its dilation are written in place every frame
+MOTION_SHAPE  = (int(IM_HEIGHT / FILTER_SCALE), int(IM_WIDTH / FILTER_SCALE))
+motionMask    = [np.empty(MOTION_SHAPE, dtype=np.uint8) for _ in range(PHASES)]
+motionDilated = [np.empty(MOTION_SHAPE, dtype=np.uint8) for _ in range(PHASES)]
+
+
+class MotionLumaOutput(object):
+    '''
+    picamera output for the low resolution YUV stream recorded on splitter port 2.  The camera's ISP scales the
+    stream down to MOTION_SHAPE in hardware, and the Y plane is already the grayscale image motion detection
+    runs on, so the CPU resize and BGR to gray conversion of the full frame are avoided.  Only the latest Y
+    plane is kept.  Raw YUV frames are padded to a width multiple of 32 and a height multiple of 16.
+    The camera delivers each frame as a new immutable bytes object, so the latest Y plane is kept as a numpy
+    view of it.  Frames are then only copied when taken by latest(), not on every camera frame.
+    '''
+    def __init__(self, shape):
+        self.height, self.width = shape
+        self.paddedWidth  = (self.width + 31) // 32 * 32
+        self.paddedHeight = (self.height + 15) // 16 * 16
+        self.luma         = np.zeros(shape, dtype=np.uint8)
+
+    def write(self, buf):
+        lumaSize = self.paddedWidth * self.paddedHeight
+        if len(buf) >= lumaSize:
+            yPlane = np.frombuffer(buf, dtype=np.uint8, count=lumaSize).reshape(self.paddedHeight, self.paddedWidth)
+            self.luma = yPlane[:self.height, :self.width]  # Replacing the reference is atomic, no lock is needed
+        return len(buf)
+
+    def flush(self):
+        pass
+
+    def latest(self, out):
+        '''
+        Copies the most recent Y plane into out.
+
+        Args:
+            out (numpy array): MOTION_SHAPE uint8 destination
+
+        Returns:
+            Nothing
+        '''
+        np.copyto(out, self.luma)
+
 categories     = [{'id': 1, 'name': 'person'}, {'id': 2, 'name': 'bicycle'}, {'id': 3, 'name': 'car'}, {'id': 4, 'name': 'motorcycle'}, {'id': 5, 'name': 'airplane'}, {'id': 6, 'name': 'bus'}, {'id': 7, 'name': 'train'}, {'id': 8, 'name': 'truck'}, {'id': 9, 'name': 'boat'}, {'id': 10, 'name': 'traffic light'}, {'id': 11, 'name': 'fire hydrant'}, {'id': 13, 'name': 'stop sign'}, {'id': 14, 'name': 'parking meter'}, {'id': 15, 'name': 'bench'}, {'id': 16, 'name': 'bird'}, {'id': 17, 'name': 'cat'}, {'id': 18, 'name': 'dog'}, {'id': 19, 'name': 'horse'}, {'id': 20, 'name': 'sheep'}, {'id': 21, 'name': 'cow'}, {'id': 22, 'name': 'elephant'}, {'id': 23, 'name': 'bear'}, {'id': 24, 'name': 'zebra'}, {'id': 25, 'name': 'giraffe'}, {'id': 27, 'name': 'backpack'}, {'id': 28, 'name': 'umbrella'}, {'id': 31, 'name': 'handbag'}, {'id': 32, 'name': 'tie'}, {'id': 33, 'name': 'suitcase'}, {'id': 34, 'name': 'frisbee'}, {'id': 35, 'name': 'skis'}, {'id': 36, 'name': 'snowboard'}, {'id': 37, 'name': 'sports ball'}, {'id': 38, 'name': 'kite'}, {'id': 39, 'name': 'baseball bat'}, {'id': 40, 'name': 'baseball glove'}, {'id': 41, 'name': 'skateboard'}, {'id': 42, 'name': 'surfboard'}, {'id': 43, 'name': 'tennis racket'}, {'id': 44, 'name': 'bottle'}, {'id': 46, 'name': 'wine glass'}, {'id': 47, 'name': 'cup'}, {'id': 48, 'name': 'fork'}, {'id': 49, 'name': 'knife'}, {'id': 50, 'name': 'spoon'}, {'id': 51, 'name': 'bowl'}, {'id': 52, 'name': 'banana'}, {'id': 53, 'name': 'apple'}, {'id': 54, 'name': 'sandwich'}, {'id': 55, 'name': 'orange'}, {'id': 56, 'name': 'broccoli'}, {'id': 57, 'name': 'carrot'}, {'id': 58, 'name': 'hot dog'}, {'id': 59, 'name': 'pizza'}, {'id': 60, 'name': 'donut'}, {'id': 61, 'name': 'cake'}, {'id': 62, 'name': 'chair'}, {'id': 63, 'name': 'couch'}, {'id': 64, 'name': 'potted plant'}, {'id': 65, 'name': 'bed'}, {'id': 67, 'name': 'dining table'}, {'id': 70, 'name': 'toilet'}, {'id': 72, 'name': 'tv'}, {'id': 73, 'name': 'laptop'}, {'id': 74, 'name': 'mouse'}, {'id': 75, 'name': 'remote'}, {'id': 76, 'name': 'keyboard'}, {'id': 77, 'name': 'cell phone'}, {'id': 78, 'name': 'microwave'}, {'id': 79, 'name': 'oven'}, {'id': 80, 'name': 'toaster'}, {'id': 81, 'name': 'sink'}, {'id': 82, 'name': 'refrigerator'}, {'id': 84, 'name': 'book'}, {'id': 85, 'name': 'clock'}, {'id': 86, 'name': 'vase'}, {'id': 87, 'name': 'scissors'}, {'id': 88, 'name': 'teddy bear'}, {'id': 89, 'name': 'hair drier'}, {'id': 90, 'name': 'toothbrush'}]
 category_index = {1: {'id': 1, 'name': 'person'}, 2: {'id': 2, 'name': 'bicycle'}, 3: {'id': 3, 'name': 'car'}, 4: {'id': 4, 'name': 'motorcycle'}, 5: {'id': 5, 'name': 'airplane'}, 6: {'id': 6, 'name': 'bus'}, 7: {'id': 7, 'name': 'train'}, 8: {'id': 8, 'name': 'truck'}, 9: {'id': 9, 'name': 'boat'}, 10: {'id': 10, 'name': 'traffic light'}, 11: {'id': 11, 'name': 'fire hydrant'}, 13: {'id': 13, 'name': 'stop sign'}, 14: {'id': 14, 'name': 'parking meter'}, 15: {'id': 15, 'name': 'bench'}, 16: {'id': 16, 'name': 'bird'}, 17: {'id': 17, 'name': 'cat'}, 18: {'id': 18, 'name': 'dog'}, 19: {'id': 19, 'name': 'horse'}, 20: {'id': 20, 'name': 'sheep'}, 21: {'id': 21, 'name': 'cow'}, 22: {'id': 22, 'name': 'elephant'}, 23: {'id': 23, 'name': 'bear'}, 24: {'id': 24, 'name': 'zebra'}, 25: {'id': 25, 'name': 'giraffe'}, 27: {'id': 27, 'name': 'backpack'}, 28: {'id': 28, 'name': 'umbrella'}, 31: {'id': 31, 'name': 'handbag'}, 32: {'id': 32, 'name': 'tie'}, 33: {'id': 33, 'name': 'suitcase'}, 34: {'id': 34, 'name': 'frisbee'}, 35: {'id': 35, 'name': 'skis'}, 36: {'id': 36, 'name': 'snowboard'}, 37: {'id': 37, 'name': 'sports ball'}, 38: {'id': 38, 'name': 'kite'}, 39: {'id': 39, 'name': 'baseball bat'}, 40: {'id': 40, 'name': 'baseball glove'}, 41: {'id': 41, 'name': 'skateboard'}, 42: {'id': 42, 'name': 'surfboard'}, 43: {'id': 43, 'name': 'tennis racket'}, 44: {'id': 44, 'name': 'bottle'}, 46: {'id': 46, 'name': 'wine glass'}, 47: {'id': 47, 'name': 'cup'}, 48: {'id': 48, 'name': 'fork'}, 49: {'id': 49, 'name': 'knife'}, 50: {'id': 50, 'name': 'spoon'}, 51: {'id': 51, 'name': 'bowl'}, 52: {'id': 52, 'name': 'banana'}, 53: {'id': 53, 'name': 'apple'}, 54: {'id': 54, 'name': 'sandwich'}, 55: {'id': 55, 'name': 'orange'}, 56: {'id': 56, 'name': 'broccoli'}, 57: {'id': 57, 'name': 'carrot'}, 58: {'id': 58, 'name': 'hot dog'}, 59: {'id': 59, 'name': 'pizza'}, 60: {'id': 60, 'name': 'donut'}, 61: {'id': 61, 'name': 'cake'}, 62: {'id': 62, 'name': 'chair'}, 63: {'id': 63, 'name': 'couch'}, 64: {'id': 64, 'name': 'potted plant'}, 65: {'id': 65, 'name': 'bed'}, 67: {'id': 67, 'name': 'dining table'}, 70: {'id': 70, 'name': 'toilet'}, 72: {'id': 72, 'name': 'tv'}, 73: {'id': 73, 'name': 'laptop'}, 74: {'id': 74, 'name': 'mouse'}, 75: {'id': 75, 'name': 'remote'}, 76: {'id': 76, 'name': 'keyboard'}, 77: {'id': 77, 'name': 'cell phone'}, 78: {'id': 78, 'name': 'microwave'}, 79: {'id': 79, 'name': 'oven'}, 80: {'id': 80, 'name': 'toaster'}, 81: {'id': 81, 'name': 'sink'}, 82: {'id': 82, 'name': 'refrigerator'}, 84: {'id': 84, 'name': 'book'}, 85: {'id': 85, 'name': 'clock'}, 86: {'id': 86, 'name': 'vase'}, 87: {'id': 87, 'name': 'scissors'}, 88: {'id': 88, 'name': 'teddy bear'}, 89: {'id': 89, 'name': 'hair drier'}, 90: {'id': 90, 'name': 'toothbrush'}}
 
@@ -224,6 +564,120 @@ catOrDogLastSeen = 0
 imageLastSent    = 0
 imageCapture     = False
 
+# Bounded hand off from the detection phases to the notification thread, notices are dropped rather than queued
+# without limit when messaging falls behind during a sustained detection event
+notifyQueue      = queue.Queue(maxsize=PHASES + 1)
+
+# Persistent worker for the sprinkler messaging.  The single worker serializes the retries, so two detections in
+# quick succession do not both open sockets to the controller.  It also sends the rare failure text itself.
+sprinklerPool    = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sprinkler')
+
+'''
+Per stage latency samples used to tune PHASES and the night mode slowdown.  Each stage keeps its most recent
+(latency in seconds, notifyQueue depth) samples:
+    frame  - capture loop period
+    wait   - time the capture loop waits on the oldest phase, non zero when detection is not keeping up
+    detect - run time of a detection phase
+    notify - time to send a notification
+A summary with the p50 / p95 latency and the maximum queue depth per stage is returned as JSON in reply to any
+UDP datagram sent to STATS_PORT, and is printed every STATS_INTERVAL seconds when DEBUG is set.  The endpoint is
+unauthenticated so it is only bound to STATS_ADDRESS, the loopback interface by default, for example on the Pi:
+    echo | nc -u -w1 127.0.0.1 2580
+'''
+STATS_INTERVAL  = 30
+STATS_ADDRESS   = '127.0.0.1'  # Set to '' to answer on all interfaces
+STATS_PORT      = 2580
+stageStats      = {stage: collections.deque(maxlen=120) for stage in ('frame', 'wait', 'detect', 'notify')}
+droppedNotices  = 0
+
+# The ring buffer file is kept across restarts, saving continues after the newest stored image
+if os.path.isfile(RING_FILE) and os.path.getsize(RING_FILE) == RING_SLOTS * RING_SLOT_SIZE:
+    ringBuffer = np.memmap(RING_FILE, dtype=np.uint8, mode='r+', shape=(RING_SLOTS, RING_SLOT_SIZE))
+    ringTimes  = [RING_HEADER.unpack_from(ringBuffer[slot])[1] for slot in range(RING_SLOTS)]
+    ringSlot   = (ringTimes.index(max(ringTimes)) + 1) % RING_SLOTS
+else:
+    ringBuffer = np.memmap(RING_FILE, dtype=np.uint8, mode='w+', shape=(RING_SLOTS, RING_SLOT_SIZE))
+    ringSlot   = 0
+ringLock       = Lock()
+
+def getSmtpServer():
+    '''
+    Returns the shared SMTP session, connecting and logging in if there is no session.  Must be called with
+    smtpLock held.
+
+    Returns:
+        smtplib.SMTP_SSL: logged in SMTP session
+    '''
+    global smtpServer
+
+    if smtpServer is not None:
+        return smtpServer
+
+    server = smtplib.SMTP_SSL(GMAIL_SMTP_SERVER, SSL_PORT, context=SSL_CONTEXT, timeout=SMTP_TIMEOUT)
+    try:
+        server.login(SENDER_EMAIL, PASSWORD)
+    except Exception:
+        server.close()
+        raise
+    smtpServer = server
+    return smtpServer
+
+
+def closeSmtpServer():
+    '''
+    Closes and drops the shared SMTP session, so the next send reconnects.  Must be called with smtpLock held.
+
+    Returns:
+        Nothing
+    '''
+    global smtpServer
+
+    if smtpServer is not None:
+        try:
+            smtpServer.close()
+        except OSError:
+            pass
+        smtpServer = None
+
+
+def sendMail(recipient, message):
+    '''
+    Sends message on the shared SMTP session.  The session is not probed before sending, the heartbeat keeps it
+    alive, so if the server has dropped it the send is retried once on a new session.
+
+    Args:
+        recipient (string): e-mail address of recipient
+        message (string): complete message including headers
+
+    Returns:
+        Nothing
+    '''
+    with smtpLock:
+        try:
+            getSmtpServer().sendmail(SENDER_EMAIL, recipient, message)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            closeSmtpServer()
+            getSmtpServer().sendmail(SENDER_EMAIL, recipient, message)
+
+
+def smtpHeartbeat():
+    '''
+    Thread sending a NOOP every SMTP_HEARTBEAT seconds so the server does not time out the shared session
+    between detection events.  A session that fails the NOOP is closed and reopened on the next send.
+
+    Returns:
+        Nothing
+    '''
+    while True:
+        time.sleep(SMTP_HEARTBEAT)
+        with smtpLock:
+            if smtpServer is not None:
+                try:
+                    smtpServer.noop()
+                except (smtplib.SMTPException, OSError):
+                    closeSmtpServer()
+
+
 def sendTextMessage(messageSubject, messageText, recipient):
     ''' 
     Sends text message (as an outbound e-mail with subject and body defined by messageText to 
@@ -243,19 +697,16 @@ def sendTextMessage(messageSubject, messageText, recipient):
               + "\r\n" \
               + messageText
 
-    context = ssl.create_default_context()
-    with smtplib.SMTP_SSL(GMAIL_SMTP_SERVER, SSL_PORT, context=context) as server:
-        server.login(SENDER_EMAIL, PASSWORD)
-        server.sendmail(SENDER_EMAIL, recipient, message)
+    sendMail(recipient, message)
     print("Message Sent")
 
 
-def sendEmailWithImage(image, subject, message_text, recipient):
+def sendEmailWithImage(imageData, subject, message_text, recipient):
     ''' 
     Sends an email with subject and body defined by textFile to recipient.
 
     Args:
-        image (cv2.img): image to be attached to e-mail
+        imageData (bytes): JPEG encoded image to be attached to e-mail
         subject (string): message subjet.
         textFile (string): pointer to text file
         recipient (string): e-mail address of recipient
@@ -292,76 +743,304 @@ def sendEmailWithImage(image, subject, message_text, recipient):
     # to use it as the img src, we don't need `<` or `>`
     # so we use [1:-1] to strip them off
 
-    # now open the image and attach it to the email
-    with open(IMAGE_FILE, 'rb') as img:
-        # know the Content-Type of the image
-        maintype, subtype = mimetypes.guess_type(img.name)[0].split('/')
-        # attach it
-        msg.get_payload()[1].add_related(img.read(),
-                                         maintype=maintype,
-                                         subtype=subtype,
-                                         cid=image_cid)
+    # now attach the image to the email
+    msg.get_payload()[1].add_related(imageData,
+                                     maintype='image',
+                                     subtype='jpeg',
+                                     cid=image_cid)
     text = msg.as_string()
-    context = ssl.create_default_context()
-    with smtplib.SMTP_SSL(GMAIL_SMTP_SERVER, SSL_PORT, context=context) as server:
-        server.login(SENDER_EMAIL, PASSWORD)
-        server.sendmail(SENDER_EMAIL, recipient, text)
+    sendMail(recipient, text)
     print("Email Sent")
 
+def saveToRing(label, frame):
+    '''
+    Saves a JPEG of frame to the next slot of the RAM disk ring buffer, overwriting the oldest image.
+
+    Args:
+        label (string): detected object(s), stored in the slot header
+        frame (frame): annotated image to save
+
+    Returns:
+        Nothing
+    '''
+    global ringSlot
+
+    ok, jpg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not ok or jpg.size > RING_SLOT_SIZE - RING_HEADER.size:
+        print(f"Error: unable to save {label} image to the ring buffer")
+        return
+    header = RING_HEADER.pack(jpg.size, time.time(), label.encode('ascii'))
+    # The slot is marked unwritten while the JPEG is copied in and its header, with the length, is written last,
+    # so a reader of the file never sees a length over old or partial image data.
+    with ringLock:
+        slot     = ringSlot
+        ringSlot = (ringSlot + 1) % RING_SLOTS
+        ringBuffer[slot, :4] = 0
+        ringBuffer[slot, RING_HEADER.size:RING_HEADER.size + jpg.size] = jpg.ravel()
+        ringBuffer[slot, :RING_HEADER.size] = np.frombuffer(header, dtype=np.uint8)
+
+
+def reportFailure(future):
+    '''
+    Done callback for pool submissions, printing an exception the task raised as it would otherwise be held
+    silently by the future.
+
+    Args:
+        future (Future): completed task
+
+    Returns:
+        Nothing
+    '''
+    if future.exception() is not None:
+        print(f"Error: background task failed: {future.exception()}")
+
+
+def sprinklerMessage(count):
+    '''
+    Builds the JSON dog warning sent to the sprinkler controller.
+
+    Args:
+        count (int): attempt number
+
+    Returns:
+        bytes: UTF-8 encoded JSON message
+    '''
+    textTime = datetime.datetime.now().strftime("%-I:%M%p")
+    msgDict  = {"Type": "Dog Warning", "Time": textTime, "Count": count}
+    return json.dumps(msgDict).encode('utf-8')
+
+
 def turnOnSprinklers():
     ''' 
-    Thread to send a JSON message, turning on the sprinklers.
+    Task run on sprinklerPool to send a JSON message, turning on the sprinklers.  The warning is first sent as
+    a UDP datagram with a short retry, which avoids connection setup and bounds the latency to
+    MAX_UDP_RETRIES * UDP_TIMEOUT.  The datagram socket is connected so a controller only listening on TCP
+    reports port unreachable (ConnectionRefusedError) straight away, and is then messaged over TCP without
+    waiting out the UDP timeouts.  TCP attempts are retried within a single TCP_DEADLINE.  A text message is
+    sent if neither is acknowledged, a reply that is not an acknowledgement object counts as no reply.
 
     Returns:
         Nothing
     '''
     HOST            = '192.168.1.244'  # Sprinkler Controller's IP address
     PORT            = 2579             # The port used by the server
-    MAX_TCP_RETRIES = 10
-    TCP_TIMEOUT     = 0.5
-
-    received = {}
-    for i in range(MAX_TCP_RETRIES):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sprinkler_socket:
+    MAX_UDP_RETRIES = 3
+    UDP_TIMEOUT     = 0.2
+    TCP_DEADLINE    = 0.8
+    TCP_TIMEOUT     = 0.3
+
+    currentTime = datetime.datetime.now()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sprinkler_socket:
+        sprinkler_socket.settimeout(UDP_TIMEOUT)
+        try:
             sprinkler_socket.connect((HOST, PORT))
-            sprinkler_socket.settimeout(TCP_TIMEOUT)
-            currentTime = datetime.datetime.now()
-            textTime = currentTime.strftime("%-I:%M%p")
-            msgDict = {"Type": "Dog Warning", "Time": textTime, "Count": i}
-            message = json.dumps(msgDict)
-            sprinkler_socket.sendall(message.encode('utf-8'))
-            try:
+            for i in range(MAX_UDP_RETRIES):
+                try:
+                    sprinkler_socket.send(sprinklerMessage(i))
+                    data = sprinkler_socket.recv(1024)
+                    received = json.loads(data)
+                    print('Received', f' {i} ', received)
+                    if isinstance(received, dict) and received.get('Type') == "Dog Warning Ack":
+                        return
+                except socket.timeout:
+                    pass
+        except (OSError, ValueError) as e:
+            print(f"Sprinkler UDP exception: {e}")
+
+    deadline = time.monotonic() + TCP_DEADLINE
+    attempts = 0
+    while time.monotonic() < deadline:
+        try:
+            connectTimeout = min(TCP_TIMEOUT, deadline - time.monotonic())
+            with socket.create_connection((HOST, PORT), timeout=connectTimeout) as sprinkler_socket:
+                # The reply is also waited for within the deadline
+                sprinkler_socket.settimeout(max(0.01, deadline - time.monotonic()))
+                sprinkler_socket.sendall(sprinklerMessage(attempts))
                 data = sprinkler_socket.recv(1024)
                 received = json.loads(data)
-                print('Received', f' {i} ', received)
-            except:
-                print("exception")
-                received['Type'] = "Exception"
-        if received['Type'] == "Dog Warning Ack":
-            break
-        if i == MAX_TCP_RETRIES - 1:
-            messageSubject = f"Failed to connect with sprinkler after {MAX_TCP_RETRIES} attempts."
-            messageText    = f'There is a dog in the front yard! {currentTime.strftime("%x %I:%M:%S %p")}'
-            try:
-                sendFailureNotice = Thread(target= sendTextMessage, args=(messageSubject, messageText, GORDONS_CELL))
-                sendFailureNotice.start()
-            except:
-                print("Error: unable to start sendFailureNotice thread")
+                print('Received', f' {attempts} ', received)
+                if isinstance(received, dict) and received.get('Type') == "Dog Warning Ack":
+                    return
+        except (OSError, ValueError) as e:
+            print(f"Sprinkler TCP exception: {e}")
+            sleep(min(0.05, max(0, deadline - time.monotonic())))  # Brief back off, a refusal returns at once
+        attempts += 1
+
+    messageSubject = f"Failed to connect with sprinkler after {MAX_UDP_RETRIES + attempts} attempts."
+    messageText    = f'There is a dog in the front yard! {currentTime.strftime("%x %I:%M:%S %p")}'
+    sendTextMessage(messageSubject, messageText, GORDONS_CELL)  # Failures are reported through the task's future
 
 
 def notify(messageSubject, messageText, frame):
     ''' 
-    Thread created to isolate the slower task of communicating and writing image to a file.
+    Thread created to isolate the slower task of communicating and encoding the image.  The JPEG is encoded in
+    memory, so there is no intermediate file another phase could overwrite before it is attached.
 
     Returns:
         Nothing
     '''
     sendTextMessage(messageSubject, messageText, GORDONS_CELL)
-    cv2.imwrite(IMAGE_FILE, frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
-    sendEmailWithImage(IMAGE_FILE, messageSubject, messageText, GORDONS_EMAIL)
+    ok, jpg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not ok:
+        print("Error: unable to encode notification image")
+        return
+    sendEmailWithImage(jpg.tobytes(), messageSubject, messageText, GORDONS_EMAIL)
+
+
+def recordStage(stage, startTime):
+    '''
+    Records a latency sample for a pipeline stage.
+
+    Args:
+        stage (string): key in stageStats
+        startTime (float): time.monotonic() at the start of the stage
+
+    Returns:
+        Nothing
+    '''
+    stageStats[stage].append((time.monotonic() - startTime, notifyQueue.qsize()))
+
+
+def statsSummary():
+    '''
+    Summarizes the stage latency samples.
+
+    Returns:
+        dict: p50 / p95 latency in seconds, maximum queue depth and sample count per stage, plus the number of
+        notices dropped since startup
+    '''
+    summary = {}
+    for stage, stageSamples in stageStats.items():
+        samples = list(stageSamples)
+        if samples:
+            latencies = np.array([sample[0] for sample in samples])
+            summary[stage] = {'p50': round(float(np.percentile(latencies, 50)), 4),
+                              'p95': round(float(np.percentile(latencies, 95)), 4),
+                              'maxDepth': max(sample[1] for sample in samples),
+                              'samples': len(samples)}
+    summary['droppedNotices'] = droppedNotices
+    return summary
+
+
+def statsServer():
+    '''
+    Thread answering UDP requests for the stage statistics on STATS_ADDRESS / STATS_PORT, and printing them every
+    STATS_INTERVAL seconds when DEBUG is set.
+
+    Returns:
+        Nothing
+    '''
+    nextLog = time.monotonic() + STATS_INTERVAL
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as statsSocket:
+        try:
+            statsSocket.bind((STATS_ADDRESS, STATS_PORT))
+        except OSError as e:
+            print(f"Error: unable to bind stats endpoint to port {STATS_PORT}, running without it: {e}")
+            return
+        while True:
+            statsSocket.settimeout(max(0.1, nextLog - time.monotonic()))
+            try:
+                _, address = statsSocket.recvfrom(64)
+                statsSocket.sendto(json.dumps(statsSummary()).encode('utf-8'), address)
+            except socket.timeout:
+                pass
+            except OSError as e:
+                print(f"Stats endpoint exception: {e}")
+            if time.monotonic() >= nextLog:
+                if DEBUG:
+                    print(f"Stage stats: {statsSummary()}")
+                nextLog += STATS_INTERVAL
+
+
+def queueNotice(messageSubject, messageText, frame):
+    '''
+    Hands a notification to the notification thread without blocking the calling detection phase.  The frame
+    is copied as the phase's buffer is reused for later captures.
+
+    Args:
+        messageSubject (string): message subject
+        messageText (string): message content
+        frame (frame): annotated image to attach to the e-mail
+
+    Returns:
+        Nothing
+    '''
+    global droppedNotices
+
+    try:
+        notifyQueue.put_nowait((messageSubject, messageText, frame.copy()))
+    except queue.Full:
+        droppedNotices += 1
+        print(f"Notification queue full, dropping: {messageSubject}")
+
+
+def notifyWorker():
+    '''
+    Thread consuming notifyQueue, so the SMTP sends are serialized on a single thread rather than a new thread
+    being created for each notice.
+
+    Returns:
+        Nothing
+    '''
+    while True:
+        messageSubject, messageText, frame = notifyQueue.get()
+        startTime = time.monotonic()
+        try:
+            notify(messageSubject, messageText, frame)
+        except (smtplib.SMTPException, OSError) as e:
+            print(f"Error: unable to send notification: {e}")
+        except Exception:
+            # Any other failure, e.g. encoding the image, must not end the only thread sending notifications
+            traceback.print_exc()
+        finally:
+            recordStage('notify', startTime)
+            notifyQueue.task_done()
+
+
+def detectPhase(frame, grayFrame, phase):
+    '''
+    Thread running object_detector for a phase and recording its run time.
+
+    Args:
+        frame (frame): image captured from camera
+        grayFrame (frame): ISP downscaled luma captured alongside frame
+        phase (int): phase the frame was captured in
+
+    Returns:
+        Nothing
+    '''
+    startTime = time.monotonic()
+    object_detector(frame, grayFrame, phase)
+    recordStage('detect', startTime)
 
 
-def object_detector(frame, cvNet):
+def phaseWorker(phase):
+    '''
+    Persistent thread running the detection for a phase, avoiding a thread being created and joined for every
+    frame.  The capture loop fills phaseFrame[phase] and phaseLuma[phase] then sets jobReady[phase], the worker
+    sets jobDone[phase] once the detection has finished with the buffers.  The worker is pinned to its own core.
+
+    Args:
+        phase (int): phase served by this worker
+
+    Returns:
+        Nothing
+    '''
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {DETECTION_CORES[phase % len(DETECTION_CORES)]})
+
+    while True:
+        jobReady[phase].wait()
+        jobReady[phase].clear()
+        try:
+            detectPhase(phaseFrame[phase], phaseLuma[phase], phase)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            jobDone[phase].set()
+
+
+def object_detector(frame, grayFrame, phase):
     '''
     This function detects motion then crops the image to the center of the motion prior to running the 
     object recognition neural net.  Object recognition performs best when the provided image has a 1:1
@@ -371,7 +1050,8 @@ def object_detector(frame, cvNet):
 
     Args:
         image (frame): image captured from camera
-        cvNet (cv2 NN): object dectecition trained neural network 
+        grayFrame (frame): ISP downscaled luma captured alongside frame, used for motion detection
+        phase (int): phase the frame was captured in, selects the background model and detection network
 
     Returns:
         Nothing
@@ -380,26 +1060,15 @@ def object_detector(frame, cvNet):
     global frameCount
     global catOrDogSeen, catOrDogLastSeen, imageLastSent
     global imageCapture
-    global referenceFrame
-    global referenceFrameTime, lastActiveTime
+    global lastActiveTime
     global refX, refY, refW, refH
-    global dogImageCount, catImageCount
 
     # Motion Detection to determine where in the full image to run object detection 
-    grayFrame = imutils.resize(frame, width=int(IM_WIDTH / FILTER_SCALE))
-    grayFrame = cv2.cvtColor(grayFrame, cv2.COLOR_BGR2GRAY)
-    grayFrame = cv2.GaussianBlur(grayFrame, (41, 41), 0)
-
-    referenceFrameAge = (cv2.getTickCount() - referenceFrameTime) / freq
-    if frameCount < 1 or referenceFrameAge > 30:
-        referenceFrame = grayFrame
-        referenceFrameTime = cv2.getTickCount()
-
-    frameDelta = cv2.absdiff(referenceFrame, grayFrame)
-    thresh = cv2.threshold(frameDelta, FOCUS_THRESHOLD, 255, cv2.THRESH_BINARY)[1]
-    # dilate the thresholded image to fill in holes, then find contours on thresholded image
-    thresh = cv2.dilate(thresh, None, iterations=2)
-    cnts = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    bgSub[phase].apply(grayFrame, fgmask=motionMask[phase])
+    # dilate the thresholded image to fill in holes, then find contours on thresholded image (findContours no
+    # longer modifies its input as of OpenCV 3.2, so no copy is needed)
+    thresh = cv2.dilate(motionMask[phase], None, dst=motionDilated[phase], iterations=2)
+    cnts = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     cnts = imutils.grab_contours(cnts)
     cnts = sorted(cnts, key=cv2.contourArea, reverse=True)[:1]
     for contour in cnts:
@@ -408,12 +1077,15 @@ def object_detector(frame, cvNet):
             (refX, refY, refW, refH) = cv2.boundingRect(contour)
             lastActiveTime = cv2.getTickCount()
 
+    # The forward pass is the single largest CPU cost, so it is skipped when there has been no motion recently
+    motionAge = (cv2.getTickCount() - lastActiveTime) / freq
+    if motionAge > MOTION_HOLD_TIME and not imageCapture and not DEBUG:
+        frameCount += 1
+        return
+
     # Use resulting focus to defne search region in input image 
     searchWidth  = int(IM_HEIGHT * 1.0)
     searchOffset = max(0, int((refX + refW/2) * FILTER_SCALE - searchWidth/2))
-    boxes        = []
-    scores       = []
-    classes      = []
 
     searchScale  = IM_WIDTH / searchWidth
     processFrame = frame[0:IM_HEIGHT, searchOffset:searchOffset + searchWidth] # format y0:y1, x0:x1
@@ -421,56 +1093,51 @@ def object_detector(frame, cvNet):
     rows = frame.shape[0]
     cols = frame.shape[1]
     # Run forward pass on object detection NN
-    cvNet.setInput(cv2.dnn.blobFromImage(processFrame, size=(BLOB_SIZE, BLOB_SIZE), swapRB=True, crop=False))
-    cvOut = cvNet.forward()
+    detections = runDetector(phase, processFrame)
     # Draw a box around the searched area
     cv2.rectangle(frame, (searchOffset, 3), (searchOffset + searchWidth, IM_HEIGHT - 3), WHITE, thickness=5)
 
+    # Filter the detections and scale their boxes to the full frame as arrays rather than per detection
+    detections = detections[detections[:, 2] > 0.3]
+    classes    = detections[:, 1].astype(np.int32)
+    scores     = detections[:, 2]
+    lefts      = (detections[:, 3] * cols / searchScale + searchOffset).astype(np.int32)
+    tops       = (detections[:, 4] * rows).astype(np.int32)
+    rights     = (detections[:, 5] * cols / searchScale + searchOffset).astype(np.int32)
+    bottoms    = (detections[:, 6] * rows).astype(np.int32)
+
     # Draw boxes and add labels around objects of interest
-    for detection in cvOut[0,0,:,:]:
-        score = float(detection[2])
-        if score > 0.3:
-            left   = int(detection[3] * cols / searchScale + searchOffset)
-            top    = int(detection[4] * rows)
-            right  = int(detection[5] * cols / searchScale + searchOffset)
-            bottom = int(detection[6] * rows)
-            boxes.append([top, left, bottom, right])
-            scores.append(score)
-            idx = int(detection[1])
-            classes.append(idx)
-            label = "{}: {:.0f}%".format(category_map[idx], score * 100)
-            y = top - 15 if top - 15 > 15 else top + 15
-            cv2.putText(frame, label, (left, y),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, BLUE, 2)
-            cv2.rectangle(frame, (int(left), int(top)), (int(right), int(bottom)), (23, 230, 210), thickness=5)
-
-    '''
-    Check the class of the top detected object by looking at classes[0][0].
+    for idx, score, left, top, right, bottom in zip(classes.tolist(), scores.tolist(), lefts.tolist(),
+                                                    tops.tolist(), rights.tolist(), bottoms.tolist()):
+        label = "{}: {:.0f}%".format(category_map[idx], score * 100)
+        y = top - 15 if top - 15 > 15 else top + 15
+        cv2.putText(frame, label, (left, y),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, BLUE, 2)
+        cv2.rectangle(frame, (left, top), (right, bottom), (23, 230, 210), thickness=5)
+
+    '''
+    Check the class of the top detected object by looking at classes[0].
     If the top detected object is a cat (17) or a dog (18) (or a teddy bear (88) for test purposes),
-    find its center coordinates by looking at the boxes[0][0] variable.
-    boxes[0][0] variable holds coordinates of detected objects as (ymin, xmin, ymax, xmax)
+    find its center coordinates from lefts[0], tops[0], rights[0] and bottoms[0].
     '''
     
-    cat      = False
-    dog      = False
-    catOrDog = False
-    if DEBUG: catOrDog = True
     frameCount += 1
-    for i in range(len(classes)):
-        if scores[i] > 0.5:
-            if int(classes[i]) == 17 or int(classes[i]) == 18:
-                catOrDog = True
-                x = int(((boxes[i][1] + boxes[i][3]) / 2))
-                y = int(((boxes[i][0] + boxes[i][2]) / 2))
-                cv2.circle(frame, (x, y), 25, (75, 13, 180), -1)
-            if int(classes[i]) == 17:
-                cat = True
-            if int(classes[i]) == 18:
-                dog = True
+    catMask  = (scores > 0.5) & (classes == 17)
+    dogMask  = (scores > 0.5) & (classes == 18)
+    cat      = bool(np.any(catMask))
+    dog      = bool(np.any(dogMask))
+    catOrDog = cat or dog or DEBUG
+
+    # Mark the center of each cat and dog
+    catOrDogMask = catMask | dogMask
+    centerXs     = ((lefts[catOrDogMask] + rights[catOrDogMask]) // 2).tolist()
+    centerYs     = ((tops[catOrDogMask] + bottoms[catOrDogMask]) // 2).tolist()
+    for x, y in zip(centerXs, centerYs):
+        cv2.circle(frame, (x, y), 25, (75, 13, 180), -1)
     if len(classes) > 0:
-        if int(classes[0]) == 17 or int(classes[0]) == 19 or int(classes[0]) == 88:
-            x = int(((boxes[0][1] + boxes[0][3]) / 2))
-            y = int(((boxes[0][0] + boxes[0][2]) / 2))
+        if classes[0] == 17 or classes[0] == 19 or classes[0] == 88:
+            x = int((lefts[0] + rights[0]) / 2)
+            y = int((tops[0] + bottoms[0]) / 2)
 
             # Draw a circle at center of object
             cv2.circle(frame, (x, y), 5, (75, 13, 180), -1)
@@ -489,11 +1156,7 @@ def object_detector(frame, cvNet):
         if (catOrDogSeen - imageLastSent) > TIME_BETWEEN_MESSAGES * freq:
             print("Sending Message")
 
-            try:
-                sprinklerThread = Thread(target= turnOnSprinklers)
-                sprinklerThread.start()
-            except:
-                print("Error: unable to start sprinkler thread")
+            sprinklerPool.submit(turnOnSprinklers).add_done_callback(reportFailure)
 
             imageLastSent = catOrDogSeen
             
@@ -502,29 +1165,16 @@ def object_detector(frame, cvNet):
             currentRealTime = datetime.datetime.now()
             messageText = f'There is a {messageObject} in the front yard! {currentRealTime.strftime("%x %I:%M:%S %p")}'
 
-            try:
-                sendNotice = Thread(target= notify, args=(messageSubject, messageText, frame))
-                sendNotice.start()
-            except:
-                print("Error: unable to start sendNotice thread")
+            queueNotice(messageSubject, messageText, frame)
         else:
-            imageFileName = f"{RAM_DISK}{messageObject}_{dogImageCount}.jpg"
-            cv2.imwrite(imageFileName, frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
-            if dog:
-                dogImageCount = (dogImageCount + 1) % 100
-            else:
-                catImageCount = (catImageCount + 1) % 100
+            saveToRing(messageObject, frame)
 
     if imageCapture == True:
         messageSubject  = "Manual Image Captured"
         currentRealTime = datetime.datetime.now()
         messageText     = f'Manual image capture @ {currentRealTime.strftime("%x %I:%M:%S %p")}'
-        try:
-            sendNotice = Thread(target=notify, args=(messageSubject, messageText, frame))
-            sendNotice.start()
-        except:
-            print("Error: unable to start image capture thread")
-        print("image captured to /var/ramdisk")
+        queueNotice(messageSubject, messageText, frame)
+        print("Manual image captured")
 
 
 def watchDogPetter():
@@ -535,39 +1185,42 @@ def watchDogPetter():
     such as network communication are monitored and the system is hard reset if those services cease to operate.
     Verifying operation via process ID is not effective for a multithreaded application, such as this one where 
     individual threads within the application need to be monitored.  As a result the hardware watchdog is called 
-    through the watchdog driver.  Via an os call.  This is the same hardware which is called through the watchdog
+    through the watchdog driver, which is opened once and written directly.  This is the same hardware which is called through the watchdog
     deamon (very unfortunately named watchdog as there is namespace colissions between the configuration of the 
     deamon and the driver, for which I have not found a definitive reference).  This implimentation does not 
     invoke the watchdog deamon as the hardware does not support competeing resources controlling the hardware.
     WARNING:  Be very careful to understand any changes made to the configuration of the driver and accidentally
     invoking the watchdog deamon as this will prevent this thread from operating.
+    NOTE: /dev/watchdog must be writable by the user running the application, DogDetect_README.txt describes the
+    udev rule and group used by DogDetect.service.  The driver starts the watchdog when the device is opened.
 
     Globals:
-        SUDO_PASSWORD (Constant String): sudo password for pi.
         WATCH_DOG_PET_INTERVAL (Constant Int): Time between petting the dog.
         keepAlive (Int): Timer counter indicating the timer thread is operating
 
     Returns:
         Nothing
     '''
-    global SUDO_PASSWORD
     global WATCH_DOG_PET_INTERVAL
     global keepAlive
 
-    command = 'sh -c "echo \'.\' >> /dev/watchdog"'
+    watchDogFd = os.open('/dev/watchdog', os.O_WRONLY)
+    petFileFd  = os.open(RAM_DISK + 'last_pet_time.txt', os.O_WRONLY | os.O_CREAT, 0o644)
     lastKeepAlive = -1
     bufferedKeepAlive = -1
     petCounter = 1
+    # Keep alive counts are rotated at least every 3 night mode frames, never more often than every pet
+    rotateEvery = max(1, int(3 * NIGHT_MODE_FRAME_SLOWDOWN / WATCH_DOG_PET_INTERVAL))
 
     while True:
         if keepAlive != lastKeepAlive:
-            p = os.system('echo %s|sudo -S %s' % (SUDO_PASSWORD, command))
+            os.write(watchDogFd, b'.')
             petCounter += 1
-            with open(RAM_DISK + 'last_pet_time.txt', "w") as petFile:
-                currentTime = datetime.datetime.now()
-                fileText = f'Last pet at : {currentTime.strftime("%x %I:%M:%S %p")}'
-                petFile.write(fileText)
-        if petCounter % int(3 * NIGHT_MODE_FRAME_SLOWDOWN/WATCH_DOG_PET_INTERVAL) == 0:
+            # %x and %p follow the locale, so the text is not necessarily ASCII
+            fileText = ('Last pet at : ' + time.strftime(PET_TIME_FORMAT)).encode('utf-8', errors='replace')
+            os.pwrite(petFileFd, fileText, 0)
+            os.ftruncate(petFileFd, len(fileText))
+        if petCounter % rotateEvery == 0:
             lastKeepAlive     = bufferedKeepAlive
             bufferedKeepAlive = keepAlive
         time.sleep(WATCH_DOG_PET_INTERVAL)
@@ -576,20 +1229,20 @@ def watchDogPetter():
 camera            = PiCamera()
 camera.resolution = (IM_WIDTH, IM_HEIGHT)
 camera.framerate  = 30  # Was 10 originally
-rawCapture        = PiRGBArray(camera, size=(IM_WIDTH, IM_HEIGHT))
-rawCapture.truncate(0)
+motionOutput      = MotionLumaOutput(MOTION_SHAPE)
+camera.start_recording(motionOutput, format='yuv', splitter_port=2, resize=(MOTION_SHAPE[1], MOTION_SHAPE[0]))
 
 phase                   = 0
 frameTotal              = 0
 avgTime                 = 0
-phaseFrame              = {}
-phaseThread             = {}
-referenceFrame          = None
+phaseFrame              = [None] * PHASES
+phaseLuma               = [np.empty(MOTION_SHAPE, dtype=np.uint8) for _ in range(PHASES)]
+phaseThread             = [None] * PHASES
+jobReady                = [Event() for _ in range(PHASES)]
+jobDone                 = [Event() for _ in range(PHASES)]
+phaseBusy               = [False] * PHASES   # Phase has been dispatched and not yet waited on
 (refX, refY,refW, refH) = (0, 0, 0, 0)
-referenceFrameTime      = 0
 lastActiveTime          = 0
-dogImageCount           = 0
-catImageCount           = 0
 nightMode               = False
 keepAlive               = 0
 
@@ -599,92 +1252,284 @@ if WATCH_DOG_ENABLE and piHost:
         watchDogPetterThread.daemon = True
         watchDogPetterThread.start()
         print("Watch Dog Petting Thread: ", watchDogPetterThread)
-    except:
-        print("Error: unable to start Watch Dog Petting thread")
-
-t1 = cv2.getTickCount()
-
-# Continuously capture frames and use delays to implement DLL
-for frame1 in camera.capture_continuous(rawCapture, format="bgr", use_video_port=True):
-
-    # Acquire frame and expand frame dimensions to have shape: [1, None, None, 3]
-    # i.e. a single-column array, where each item in the column has the pixel RGB value
-
-    phaseFrame[phase] = np.copy(frame1.array)
-    phaseFrame[phase].setflags(write=1)
-
-    # Dark frames are detected to determine when to slow down the system as once the 
-    # images are dark enough, the object detection will not work.  This allows the 
-    # system to reduce power consumption and should extend the life of the Pi versus
-    # running it hot 100% of the time.
-    darkDetectFrame = imutils.resize(phaseFrame[phase], width=int(IM_WIDTH / 32))
-    darkDetectFrame = cv2.cvtColor(darkDetectFrame, cv2.COLOR_BGR2GRAY)
-    LumaAvg = cv2.mean(darkDetectFrame)
-    if LumaAvg[0] < NIGHT_MODE_ON_THRESH and not nightMode:
-        nightMode = True
-    elif LumaAvg[0] > NIGHT_MODE_OFF_THRESH and nightMode:
-        nightMode = False
-        t1 = cv2.getTickCount()
-        frameTotal = frameTotal % PHASES + PHASES
-        avgTime = 0.5
+    except RuntimeError as e:
+        print(f"Error: unable to start Watch Dog Petting thread: {e}")
+
+try:
+    notifyThread = Thread(target=notifyWorker)
+    notifyThread.daemon = True
+    notifyThread.start()
+except RuntimeError as e:
+    print(f"Error: unable to start notification thread: {e}")
+
+try:
+    smtpHeartbeatThread = Thread(target=smtpHeartbeat)
+    smtpHeartbeatThread.daemon = True
+    smtpHeartbeatThread.start()
+except RuntimeError as e:
+    print(f"Error: unable to start SMTP heartbeat thread: {e}")
+
+try:
+    statsThread = Thread(target=statsServer)
+    statsThread.daemon = True
+    statsThread.start()
+except RuntimeError as e:
+    print(f"Error: unable to start stats thread: {e}")
+
+for i in range(PHASES):
+    try:
+        phaseThread[i] = Thread(target=phaseWorker, args=(i,))
+        phaseThread[i].daemon = True
+        phaseThread[i].start()
+    except RuntimeError as e:
+        # The capture loop waits on every phase in turn, so it can not run without all of its workers
+        raise SystemExit(f"Error: unable to start detection thread {i}: {e}")
 
+'''
+The camera captures directly into a ring of preallocated buffers, so there is no PiRGBArray copy per frame.  Raw
+BGR captures are padded to a width multiple of 32 and a height multiple of 16, so each buffer is allocated at the
+padded size and captureFrame holds the IM_HEIGHT x IM_WIDTH view of it.  picamera runs capture_sequence's
+generator on its encoder callback thread, so the generator (captureSlots) only hands the camera a free slot and
+queues the filled one, and the frame loop runs on the main thread.  The ring holds PHASES + 2 slots: one per phase
+(owned until the phase is refilled), one being captured into and one filled and waiting for the frame loop.
+dropBuffer is captured into on the rare occasions no slot is available, so the camera is never blocked.
+'''
+RAW_WIDTH       = (IM_WIDTH + 31) // 32 * 32
+RAW_HEIGHT      = (IM_HEIGHT + 15) // 16 * 16
+CAPTURE_BUFFERS = PHASES + 2
+captureBuffer   = [np.empty((RAW_HEIGHT, RAW_WIDTH, 3), dtype=np.uint8) for _ in range(CAPTURE_BUFFERS)]
+captureFrame    = [buffer[:IM_HEIGHT, :IM_WIDTH] for buffer in captureBuffer]
+dropBuffer      = np.empty((RAW_HEIGHT, RAW_WIDTH, 3), dtype=np.uint8)
+freeSlots       = queue.Queue()   # Slots the camera may capture into
+filledSlots     = queue.Queue()   # Captured slots, oldest first, None once capture has ended
+phaseSlot       = [None] * PHASES # Slot each phase's frame was captured into
+captureStop     = Event()
+for i in range(CAPTURE_BUFFERS):
+    freeSlots.put(i)
+
+SPIN_SLACK_NS   = 200000  # Final part of a pacing wait which is spun rather than slept
+DONE_SPINS      = 100     # Polls of a phase's jobDone before blocking on it
+
+
+def waitUntil(deadline):
+    '''
+    Waits for the DLL until a time.monotonic_ns deadline.  The wait is slept until SPIN_SLACK_NS before the
+    deadline and spun for the remainder, as sleep can overshoot by a scheduler quantum (several ms on the Pi)
+    which directly lengthens the frame.
+
+    Args:
+        deadline (int): time.monotonic_ns value to wait until
+
+    Returns:
+        Nothing
+    '''
+    remaining = deadline - time.monotonic_ns() - SPIN_SLACK_NS
+    if remaining > 0:
+        sleep(remaining * 1e-9)
+    while time.monotonic_ns() < deadline:
+        pass
+
+
+def captureSlots():
+    '''
+    Generator driving camera.capture_sequence, run on picamera's encoder callback thread so it must never block.
+    Each yielded buffer is captured into by the camera, and the generator is resumed once that capture has
+    completed, when the slot is queued for the frame loop.  When the frame loop has fallen behind, the oldest
+    unconsumed frame's slot is reused.  Returning, once captureStop is set, ends the capture sequence.
+
+    Returns:
+        Nothing
+    '''
+    while not captureStop.is_set():
+        try:
+            slot = freeSlots.get_nowait()
+        except queue.Empty:
+            try:
+                slot = filledSlots.get_nowait()
+            except queue.Empty:
+                slot = None
+        if slot is None:
+            yield dropBuffer
+        else:
+            yield captureBuffer[slot]
+            filledSlots.put(slot)
+
+
+def captureWorker():
+    '''
+    Thread running the camera capture sequence, which blocks until captureSlots returns.
+
+    Returns:
+        Nothing
+    '''
     try:
-        phaseThread[phase] = Thread(target=object_detector, args=(phaseFrame[phase], cvNet[phase]))
-        phaseThread[phase].start()
-    except:
-         print(f"Error: unable to start thread {phase}")
-    if frameTotal < PHASES:
-        frame = np.copy(frame1.array)
-        sleep(0.25)
-    else:
-        phaseThread[(phase + 1) % PHASES].join()
-        frame = np.copy(phaseFrame[(phase + 1) % PHASES])
-        deltaTime = (cv2.getTickCount() - t1) / freq
-        if deltaTime < 0.75 * avgTime:
-            sleep(0.9*(avgTime-deltaTime))
-        if nightMode:
-            sleep(NIGHT_MODE_FRAME_SLOWDOWN)
-
-    # FPS calculation
-    t2              = cv2.getTickCount()
-    time1           = (t2 - t1) / freq
-    avgTime         = (avgTime*frameTotal + time1) / (frameTotal + 1)
-    frame_rate_calc = 1 / time1
-    text            = f"FPS {frame_rate_calc:.2f}  Avg Time: {avgTime:.2f}  Avg Luma {LumaAvg[0]:.0f}"
-    if frameCount % 1000 == 8: print(text)
-    print(text)
-    t1 = t2
-
-    # resize image
-    width   = int(frame.shape[1] * scale_percent / 100)
-    height  = int(frame.shape[0] * scale_percent / 100)
-    dim     = (width, height)
-    display = cv2.resize(frame, dim, interpolation=cv2.INTER_AREA)
-
-    # Draw FPS
-    location  = (20, 20)
-    fontScale = 1 * IM_HEIGHT / 1200
-    thickness = 1
-    cv2.putText(display, text, location, font, fontScale, BLUE, thickness, cv2.LINE_AA)
-
-    # Display Frame
-    if not args.serviceMode and DISPLAY_ON:  # Don't display in service mode as the desktop is not accessible
-        cv2.imshow('Object detector', display)
-
-        # Press 'q' to quit 'c' to capture image
-        keyValue = cv2.waitKey(1)
-        if keyValue == ord('q'):
+        camera.capture_sequence(captureSlots(), format="bgr", use_video_port=True)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        filledSlots.put(None)  # Wakes and ends the frame loop
+
+
+def nextCapture():
+    '''
+    Waits for a captured frame and returns the newest one, returning the slots of any older frames to the camera.
+
+    Returns:
+        int: capture slot holding the frame, None once capture has ended
+    '''
+    slot = filledSlots.get()
+    while slot is not None:
+        try:
+            newer = filledSlots.get_nowait()
+        except queue.Empty:
             break
-        elif keyValue == ord('c'):
-            imageCapture = True
-        else:
-            imageCapture = False
+        freeSlots.put(slot)
+        slot = newer
+    return slot
+
 
-    rawCapture.truncate(0)
-    phase       = (phase + 1) % PHASES
-    frameTotal += 1
-    keepAlive  += 1
+def processFrames():
+    '''
+    Frame loop implementing the DLL, run on the main thread.  Each captured frame is handed to a phase's
+    detection worker and the oldest phase in flight is displayed.  Returns when 'q' is pressed or capture ends.
 
+    Returns:
+        Nothing
+    '''
+    global phase, frameTotal, avgTime, nightMode, keepAlive, imageCapture
+    global t1, frameStart, frame_rate_calc
+
+    while True:
+        slot = nextCapture()
+        if slot is None:
+            return
+
+        # The camera has written the frame directly into a capture slot.  The slot is owned by its phase until the
+        # phase is next refilled, by which time the phase's job is complete and the frame has been displayed,
+        # anything a phase hands on to other threads (notifications) is copied by queueNotice.
+        if phaseSlot[phase] is not None:
+            freeSlots.put(phaseSlot[phase])
+        phaseSlot[phase]  = slot
+        phaseFrame[phase] = captureFrame[slot]
+        motionOutput.latest(phaseLuma[phase])
+
+        # Dark frames are detected to determine when to slow down the system as once the 
+        # images are dark enough, the object detection will not work.  This allows the 
+        # system to reduce power consumption and should extend the life of the Pi versus
+        # running it hot 100% of the time.
+        # The luma estimate is a scalar, so a 1 in 32 strided view (no copy) of the frame is weighted with the BGR
+        # to gray coefficients and summed in a single reduction rather than resizing and converting the full frame.
+        darkDetectFrame = phaseFrame[phase][::DARK_DETECT_STRIDE, ::DARK_DETECT_STRIDE, :]
+        LumaAvg = (float(np.einsum('ijk,k->', darkDetectFrame, BGR_WEIGHTS, dtype=np.float32)) * DARK_DETECT_SCALE,)
+        if LumaAvg[0] < NIGHT_MODE_ON_THRESH and not nightMode:
+            nightMode = True
+        elif LumaAvg[0] > NIGHT_MODE_OFF_THRESH and nightMode:
+            nightMode = False
+            t1 = time.monotonic_ns()
+            frameTotal = frameTotal % PHASES + PHASES
+            avgTime = 0.5
+
+        # Too dark for the detector to be of any use, so in night mode no detection is dispatched and the
+        # current frame is displayed as is.  Phases dispatched before night mode was entered are still waited on.
+        if not nightMode:
+            jobReady[phase].set()
+            phaseBusy[phase] = True
+
+        # The oldest phase in flight is always waited on, warm up included, so every iteration ends with the next
+        # phase's job complete and its buffers free to be refilled, and each jobDone is that phase's latest job.
+        nextPhase = (phase + 1) % PHASES
+        if phaseBusy[nextPhase]:
+            # The detector has usually finished by now, so jobDone is polled (a flag read, no lock) a
+            # bounded number of times before falling back to blocking on the Event.
+            waitStart = time.monotonic()
+            for _ in range(DONE_SPINS):
+                if jobDone[nextPhase].is_set():
+                    break
+            else:
+                jobDone[nextPhase].wait()
+            jobDone[nextPhase].clear()
+            phaseBusy[nextPhase] = False
+            recordStage('wait', waitStart)
+
+        if frameTotal < PHASES:
+            # While warming up the captured frames are still owned by their phase's workers, so nothing is displayed
+            frame = None
+            waitUntil(t1 + 250000000)
+        else:
+            frame = phaseFrame[phase] if nightMode else phaseFrame[nextPhase]
+            # The DLL only paces day frames, in night mode the frame period is set by the slowdown alone so that
+            # it does not grow with avgTime (keepAlive must keep changing within the watchdog's rotation time)
+            if nightMode:
+                sleep(NIGHT_MODE_FRAME_SLOWDOWN)
+            else:
+                deltaTime = (time.monotonic_ns() - t1) * 1e-9
+                if deltaTime < 0.75 * avgTime:
+                    waitUntil(t1 + int((0.1*deltaTime + 0.9*avgTime) * 1e9))
+
+        # FPS calculation
+        t2              = time.monotonic_ns()
+        time1           = (t2 - t1) * 1e-9
+        avgTime        += (time1 - avgTime) / (frameTotal + 1)  # Incremental running mean, stable over long runs
+        frame_rate_calc = 1 / time1
+        text            = f"FPS {frame_rate_calc:.2f}  Avg Time: {avgTime:.2f}  Avg Luma {LumaAvg[0]:.0f}"
+        if frameCount % 1000 == 8: print(text)
+        t1 = t2
+        recordStage('frame', frameStart)
+        frameStart = time.monotonic()
+
+        # Display Frame
+        if DISPLAYING and frame is not None:  # Don't display in service mode as the desktop is not accessible
+            # resize image
+            source  = cv2.UMat(frame) if USE_OPENCL else frame
+            display = cv2.resize(source, DISPLAY_DIM, dst=displayBuf, interpolation=cv2.INTER_AREA)
+
+            # Draw FPS
+            cv2.putText(display, text, (20, 20), font, FONT_SCALE, BLUE, 1, cv2.LINE_AA)
+
+            cv2.imshow('Object detector', display)
+
+            # Press 'q' to quit 'c' to capture image
+            keyValue = cv2.waitKey(1)
+            if keyValue == ord('q'):
+                return
+            elif keyValue == ord('c'):
+                imageCapture = True
+            else:
+                imageCapture = False
+
+        phase       = (phase + 1) % PHASES
+        frameTotal += 1
+        keepAlive  += 1
+
+
+# The displayed image is resized into a preallocated buffer.  When the display is in use and OpenCV has an OpenCL
+# device the display image operations run through the T-API on UMats, offloading them from the cores running
+# detection.  OpenCL use is process wide, so it is only switched on when displaying (not in service mode).
+DISPLAY_DIM = (int(IM_WIDTH * scale_percent / 100), int(IM_HEIGHT * scale_percent / 100))
+FONT_SCALE  = IM_HEIGHT / 1200
+DISPLAYING  = not args.serviceMode and DISPLAY_ON
+USE_OPENCL  = DISPLAYING and cv2.ocl.haveOpenCL()
+if USE_OPENCL:
+    cv2.ocl.setUseOpenCL(True)
+    displayBuf = cv2.UMat(DISPLAY_DIM[1], DISPLAY_DIM[0], cv2.CV_8UC3)
+else:
+    displayBuf = np.empty((DISPLAY_DIM[1], DISPLAY_DIM[0], 3), dtype=np.uint8)
+
+t1 = time.monotonic_ns()
+frameStart = time.monotonic()
+
+# Continuously capture frames on the capture thread and use delays in the frame loop to implement DLL
+try:
+    captureThread = Thread(target=captureWorker)
+    captureThread.daemon = True
+    captureThread.start()
+except RuntimeError as e:
+    raise SystemExit(f"Error: unable to start capture thread: {e}")
+processFrames()
+captureStop.set()
+captureThread.join()
+
+camera.stop_recording(splitter_port=2)
 camera.close()
 
 cv2.destroyAllWindows()